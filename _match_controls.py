@@ -180,18 +180,18 @@ def test_Everything(verbose, inputdata, keep, control, case, nullvalues, match,
     csvdata_filter = Metadata.load(csvdata_filter).to_dataframe()
     csvdata_match = Metadata.load(csvdata_match).to_dataframe()
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":keep, "control":control, "case":case, "nullvalues":nullvalues, "match":match}
     #loads and opens input files
     inputDict = match_controls.get_user_input_query_lines(verbose,inputDict)
     
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
     afterExclusionMD = match_controls.keep_samples(verbose, inputDict["inputdata"], inputDict["keep"])
     
     
-    tkeep = time.clock()
+    tkeep = time.perf_counter()
     keep = test_keep_samples(afterExclusionMD, csvdata_keep)
     if verbose:
         print("keep_samples function works correctly is %s"%(keep))
@@ -208,7 +208,7 @@ def test_Everything(verbose, inputdata, keep, control, case, nullvalues, match,
 
     case_controlMD = match_controls.determine_cases_and_controls(verbose, afterExclusionMD, case_control_dict, case_controlDF)
 
-    tcase_control = time.clock()
+    tcase_control = time.perf_counter()
     case_control = test_determine_cases_and_controls(case_controlMD, csvdata_case_control)
     if verbose:
         print("determine_cases_and_controls function works correctly is %s"%(case_control))
@@ -216,7 +216,7 @@ def test_Everything(verbose, inputdata, keep, control, case, nullvalues, match,
 
     prepped_for_matchMD= match_controls.filter_prep_for_matchMD(verbose, case_controlMD, inputDict["match"], inputDict["nullvalues"])
 
-    tprepped = time.clock()
+    tprepped = time.perf_counter()
     prepped = test_filter_prep_for_matchMD(prepped_for_matchMD, csvdata_filter)
     if verbose:
         print("filter_prep_for_matchMD function works correctly is %s"%(prepped))
@@ -225,8 +225,8 @@ def test_Everything(verbose, inputdata, keep, control, case, nullvalues, match,
     if inputDict["match"] != False:
         matchedMD = match_controls.match_samples(verbose, prepped_for_matchMD, inputDict["match"] )
         matchedMD.to_dataframe().to_csv(output, sep = '\t')
-    tmatch = time.clock()
-    tend = time.clock()
+    tmatch = time.perf_counter()
+    tend = time.perf_counter()
     match = test_match_samples(matchedMD, csvdata_match)
     if verbose:
         print("match_samples function works correctly is %s"%(match))
@@ -13,6 +13,57 @@ import click
 
 from qiime2 import Metadata
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _intersect_range_conditions(candidate_numbers, low_bounds, high_bounds):
+    '''
+    applies every range condition to the candidate control rows in one call
+
+    Parameters
+    ----------
+    candidate_numbers: 2d numpy array of floats
+        one row per range condition holding the numeric values of the candidate control rows
+
+    low_bounds: numpy array of floats
+        smallest value a control row may have for each condition
+
+    high_bounds: numpy array of floats
+        largest value a control row may have for each condition
+
+    Returns
+    -------
+    keep: numpy array of booleans
+        True for the candidate control rows that fall inside every range
+    '''
+    keep = np.ones(candidate_numbers.shape[1], dtype=np.bool_)
+    for condition in range(candidate_numbers.shape[0]):
+        keep &= ( candidate_numbers[condition] >= low_bounds[condition] )
+        keep &= ( candidate_numbers[condition] <= high_bounds[condition] )
+    return keep
+
+try:
+    # when numba is installed the comparisons are fused into one compiled pass with
+    # no boolean temporaries; the NumPy version above stays as the fallback
+    from numba import njit
+
+    @njit(cache=True)
+    def _intersect_range_conditions(candidate_numbers, low_bounds, high_bounds):
+        keep = np.empty(candidate_numbers.shape[1], dtype=np.bool_)
+        for row in range(candidate_numbers.shape[1]):
+            inside = True
+            for condition in range(candidate_numbers.shape[0]):
+                value = candidate_numbers[condition, row]
+                # direct comparisons so NaN values fail the test and are
+                # excluded just like in the NumPy fallback above
+                if not ( low_bounds[condition] <= value and value <= high_bounds[condition] ):
+                    inside = False
+                    break
+            keep[row] = inside
+        return keep
+except ImportError:
+    pass
+
 
 class Stable_Marriage:
     
@@ -93,8 +144,6 @@ class Stable_Marriage:
         '''
         #orders control samples (elements) by rising abundance of how many case samples they match to
         case_dictionary = self.orderDict(verbose, case_dictionary, pref_counts_control)
-        #first make master copy
-        master_copy_of_case_dict = case_dictionary.copy()
 
         free_keys = self.order_keys(verbose, case_dictionary)
 
@@ -170,9 +219,12 @@ def get_user_input_query_lines(verbose, dictofFiles):
             if verbose:
                     print("file path entered is %s"%(dictofFiles[key]))
             try:
-                dict_of_file_lines[key] = open('./%s'%(dictofFiles[key]),'r').readlines()
+                # the with block guarantees the file handle is closed and the lines are
+                # stripped of their newlines once here instead of at every use
+                with open(dictofFiles[key], 'r') as file_of_queries:
+                    dict_of_file_lines[key] = tuple( line.rstrip('\n') for line in file_of_queries )
             except:
-                raise ValueError('File could not be opened') 
+                raise ValueError('File could not be opened')
     return dict_of_file_lines
 
 
@@ -347,61 +399,144 @@ def match_samples(verbose, prepped_for_match_MD, conditions_for_match_lines):
 
     '''
     case_dictionary = {}
-    control_dictionary = {}
     control_match_count_dictionary = {}
     case_match_count_dictionary = {}
 
     matchDF = prepped_for_match_MD.to_dataframe()
-    case_for_matchDF = matchDF[matchDF['case_control'].isin(['case'])]
     # creates column to show matches. since it will contain the sample number it was matched too the null value will be 0
     matchDF['matched_to'] = '0'
 
-    # loops though case samples and matches them to controls
-    for case_index, case_row in case_for_matchDF.iterrows():
-        #print('case index is %s'%(case_index))
-
-        # set matchDF to be only the samples of masterDF that are control samples
-        controlDF = matchDF[matchDF['case_control'].isin(['control'])]
+    # parses the condition lines once into (match type, column name, range number)
+    # tuples so the loops below never re-split the same strings
+    match_plan = []
+    for conditions in conditions_for_match_lines:
+        parts = conditions.split('\t')
+        column_name = parts[1].strip()
+        if parts[0] == 'range':
+            try:
+                fnum = float(parts[2].strip())
+            except:
+                raise ValueError('input number for condition %s is not a a valid number'%(column_name))
+        else:
+            fnum = None
+        match_plan.append((parts[0], column_name, fnum))
+
+    # only the columns named in the conditions are read below, so project them once
+    # instead of dragging every metadata column through the groupbys and case arrays
+    needed_columns = []
+    for match_type, column_name, fnum in match_plan:
+        if column_name not in needed_columns:
+            needed_columns.append(column_name)
+
+    # precomputes what the conditions compare against so the case loop works on
+    # arrays instead of rebuilding a control DataFrame for every case sample; every
+    # array is pre-sliced to the control rows, so the per case candidates are
+    # positions into control_ids rather than into all of matchDF
+    control_mask = (matchDF['case_control'].values == 'control')
+    control_for_matchDF = matchDF.loc[control_mask, needed_columns]
+    control_ids = control_for_matchDF.index.to_numpy()
+    control_row_positions = np.arange(control_ids.size)
+    exact_match_groups = {}
+    exact_match_categories = {}
+    range_match_columns = {}
+    for match_type, column_name, fnum in match_plan:
+        if match_type == 'range':
+            try:
+                range_match_columns[column_name] = pd.to_numeric(control_for_matchDF[column_name]).values
+            except:
+                raise ValueError('column %s contains a string that can not be converted to a numerical value'%(column_name))
+        else:
+            # encodes the column as categorical integer codes so the per case bucket
+            # lookups hash small integers instead of strings, then buckets the
+            # control row positions by code once so each case looks its own code up
+            # instead of scanning the whole column
+            categories = pd.Categorical(matchDF[column_name])
+            exact_match_categories[column_name] = categories.categories
+            control_codes = pd.Series(categories.codes[control_mask])
+            exact_match_groups[column_name] = dict(control_codes.groupby(control_codes).indices)
+
+    # the range conditions are applied together below, so their columns and range
+    # numbers are lined up once here
+    range_columns = [column_name for match_type, column_name, fnum in match_plan if match_type == 'range']
+    range_fnums = [fnum for match_type, column_name, fnum in match_plan if match_type == 'range']
+
+    # iterrows boxes every case row into a Series; pull the needed columns out as
+    # arrays once and build a small dict per case instead
+    # == on the underlying array beats isin with a single element list, which builds
+    # a hash table and probes it per row
+    case_for_matchDF = matchDF.loc[matchDF['case_control'].values == 'case', needed_columns]
+    case_index_array = case_for_matchDF.index.to_numpy()
+    case_column_arrays = {column_name: case_for_matchDF[column_name].to_numpy() for column_name in needed_columns}
+    # exact match columns are compared as integer codes, so encode the case rows once
+    # with the same categories the control buckets were built from; the raw values
+    # stay in case_column_arrays for the range conditions
+    case_exact_codes = {column_name: pd.Categorical(case_for_matchDF[column_name], categories=exact_match_categories[column_name]).codes
+                        for column_name in exact_match_categories}
+
+    def match_one_case(case_position):
+        '''
+        finds the control samples that satisfy every condition for one case sample.
+        Only reads the precomputed arrays above so it is safe to run for many cases at once.
 
-        # loop though input columns to determine matches
-        for conditions in conditions_for_match_lines:
+        Parameters
+        ----------
+        case_position: integer
+            position of the case sample in case_index_array
 
-            column_name = conditions.split('\t')[1].strip()
+        Returns
+        -------
+        matching_ids: numpy array
+            ids of the control samples the case sample matches to
+        '''
+        case_row = {column_name: case_column_arrays[column_name][case_position] for column_name in needed_columns}
 
-            # get the type of data for the given column. This determine how a match is determined
-            if conditions.split('\t')[0] == 'range':
-                num = conditions.split('\t')[2].strip()
-                
+        # exact conditions become bucket lookups whose intersection narrows the candidates
+        candidate_positions = control_row_positions
+        for match_type, column_name, fnum in match_plan:
+            if match_type == 'range':
+                continue
+            bucket = exact_match_groups[column_name].get(case_exact_codes[column_name][case_position])
+            if bucket is None:
+                # no control sample shares this value so nothing can match
+                candidate_positions = control_row_positions[:0]
+                break
+            candidate_positions = np.intersect1d(candidate_positions, bucket, assume_unique=True)
+            if candidate_positions.size == 0:
+                break
+
+        # range conditions only look at the rows that survived the exact conditions
+        # and are applied together in one pass instead of one mask per condition
+        if range_columns:
+            low_bounds = np.empty(len(range_columns))
+            high_bounds = np.empty(len(range_columns))
+            for condition, column_name in enumerate(range_columns):
                 try:
                     row_num = float(case_row[column_name])
                 except:
                     raise ValueError('%s is not a a valid number'%(case_row[column_name]))
-                try:
-                    fnum = float(num)
-                except:
-                    raise ValueError('input number for condition %s is not a a valid number'%(column_name))
-                try:
-                    nums_in_column = pd.to_numeric(controlDF[column_name])
-                except:
-                    raise ValueError('column %s contains a string that can not be converted to a numerical value'%(column_name))
-
+                low_bounds[condition] = row_num - range_fnums[condition]
+                high_bounds[condition] = row_num + range_fnums[condition]
+            if candidate_positions.size != 0:
                 # filters controls based on if the value in the control is not within a given distance form the case
-                controlDF = controlDF[
-                                    ( nums_in_column >= ( row_num - fnum ) )
-                                    &
-                                    ( nums_in_column <= ( row_num + fnum ) )
-                                    ]
-            else:
-                # filters controls if the strings for the control and case don't match
-                controlDF = controlDF[controlDF[column_name].isin([case_row[column_name]])]
-
-        case_dictionary.update({case_index:controlDF.index.values})
-        case_match_count_dictionary.update({case_index:(controlDF.index.values.size)})
-
-        for id_control in controlDF.index:
-            if id_control not in control_match_count_dictionary:
-                control_match_count_dictionary.update({id_control:0})
-            control_match_count_dictionary.update({id_control:(control_match_count_dictionary[id_control]+1)})
+                candidate_numbers = np.stack([range_match_columns[column_name][candidate_positions] for column_name in range_columns])
+                candidate_positions = candidate_positions[_intersect_range_conditions(candidate_numbers, low_bounds, high_bounds)]
+
+        return control_ids[candidate_positions]
+
+    # every case only reads the shared precomputed arrays, so the cases are matched
+    # in parallel; threads are enough because NumPy releases the GIL in its ufuncs
+    with ThreadPoolExecutor() as case_executor:
+        for case_position, matching_ids in enumerate(case_executor.map(match_one_case, range(len(case_index_array)))):
+            case_index = case_index_array[case_position]
+            case_dictionary.update({case_index:matching_ids})
+            case_match_count_dictionary.update({case_index:(matching_ids.size)})
+
+    # counts how many case samples every control matched to in one vectorized pass
+    # instead of incrementing a dictionary entry per match inside the case loop
+    if case_dictionary:
+        all_matched_controls = np.concatenate(list(case_dictionary.values()))
+        unique_controls, match_counts = np.unique(all_matched_controls, return_counts=True)
+        control_match_count_dictionary = dict(zip(unique_controls.tolist(), match_counts.tolist()))
 
     stable = Stable_Marriage()
     case_to_control_match = stable.stableMarriageRunner(verbose, case_dictionary, control_match_count_dictionary, case_match_count_dictionary)
@@ -409,10 +544,16 @@ def match_samples(verbose, prepped_for_match_MD, conditions_for_match_lines):
     if verbose:
         print("%s sample pairs matched together"%(len(case_to_control_match.keys())))
         
-    for key in case_to_control_match:
-        key_value = case_to_control_match[key]
-        matchDF.loc[ key, 'matched_to'] = key_value
-        matchDF.loc[ key_value, 'matched_to'] = key
+    # two vectorized writes instead of two .loc scalar assignments per matched pair
+    if case_to_control_match:
+        matched_control_ids = np.array(list(case_to_control_match.keys()))
+        matched_case_ids = np.array(list(case_to_control_match.values()))
+        matchDF.loc[ matched_control_ids, 'matched_to'] = matched_case_ids
+        # stableMarriageRunner can pair several controls with the same case since it
+        # re-queues matched cases, so collapse the duplicates to the last control per
+        # case the way the scalar loop did; dict insertion order keeps the last pair
+        last_control_for_case = {case_index: id_control for id_control, case_index in case_to_control_match.items()}
+        matchDF.loc[ np.array(list(last_control_for_case.keys())), 'matched_to'] = np.array(list(last_control_for_case.values()))
 
     return Metadata(matchDF)
 
@@ -446,20 +587,20 @@ def KeepOnly(verbose,inputdata,keep,output):
     
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":keep, "control":None, "case":None, "nullvalues":None, "match":None}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)
     
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
 
     afterExclusionMD = keep_samples(verbose, inputDict["inputdata"], inputDict["keep"])
     afterExclusionMD.to_dataframe().to_csv(output, sep = '\t')
 
-    tkeep = time.clock()
-    tend = time.clock()
+    tkeep = time.perf_counter()
+    tend = time.perf_counter()
 
     if verbose:
         print('Time to filter out unwanted samples is %s'%(tkeep - tloadedFiles))
@@ -493,12 +634,12 @@ def ControlAndCaseOnly(verbose,inputdata,control,case,output):
     
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":None, "control":control, "case":case, "nullvalues":None, "match":None}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)
 
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
         
@@ -515,8 +656,8 @@ def ControlAndCaseOnly(verbose,inputdata,control,case,output):
 
     case_controlMD.to_dataframe().to_csv(output, sep = '\t')
 
-    tcase_control = time.clock()
-    tend = time.clock()
+    tcase_control = time.perf_counter()
+    tend = time.perf_counter()
     if verbose:
         print('Time to label case and control samples is %s'%(tcase_control - tloadedFiles))
         print('Time to do everything %s'%(tend-tstart))
@@ -547,16 +688,16 @@ def KeepAndControlCase(verbose,inputdata,keep,control,case,output):
     
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":keep, "control":control, "case":case, "nullvalues":None, "match":None}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)
 
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
     afterExclusionMD = keep_samples(verbose, inputDict["inputdata"], inputDict["keep"])
-    tkeep = time.clock()
+    tkeep = time.perf_counter()
     if verbose:
         print('Time to filter out unwanted samples is %s'%(tkeep - tloadedFiles))
     ids = afterExclusionMD.get_ids()
@@ -571,8 +712,8 @@ def KeepAndControlCase(verbose,inputdata,keep,control,case,output):
 
     case_controlMD = determine_cases_and_controls(verbose, afterExclusionMD, case_control_dict, case_controlDF)
     case_controlMD.to_dataframe().to_csv(output, sep = '\t')
-    tcase_control = time.clock()
-    tend = time.clock() 
+    tcase_control = time.perf_counter()
+    tend = time.perf_counter() 
     if verbose:
         print('Time to label case and control samples is %s'%(tcase_control - tkeep))
         print('Time to do everything %s'%(tend-tstart))
@@ -603,12 +744,12 @@ def ControlCaseAndMatch(verbose,inputdata,control,case,match,output):
      
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":None, "control":control, "case":case, "nullvalues":None, "match":match}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)    
     
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
 
@@ -623,15 +764,15 @@ def ControlCaseAndMatch(verbose,inputdata,control,case,match,output):
     case_control_dict = {'case':inputDict["case"], 'control':inputDict["control"] }
     case_controlMD = determine_cases_and_controls(verbose, inputDict["inputdata"], case_control_dict, case_controlDF)
 
-    tcase_control = time.clock()
+    tcase_control = time.perf_counter()
     if verbose:
         print('Time to label case and control samples is %s'%(tcase_control - tloadedFiles))
 
     matchedMD = match_samples(verbose, case_controlMD, inputDict["match"] )
     matchedMD.to_dataframe().to_csv(output, sep = '\t')
 
-    tmatch = time.clock()
-    tend = time.clock()
+    tmatch = time.perf_counter()
+    tend = time.perf_counter()
     if verbose:
         print('Time to match is %s'%(tmatch- tcase_control))
         print('Time to do everything %s'%(tend-tstart))
@@ -668,12 +809,12 @@ def ControlCaseNullAndMatch(verbose,inputdata,control,case,nullvalues,match,outp
      
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":None, "control":control, "case":case, "nullvalues":nullvalues, "match":match}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)
     
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
 
@@ -689,14 +830,14 @@ def ControlCaseNullAndMatch(verbose,inputdata,control,case,nullvalues,match,outp
 
     case_controlMD = determine_cases_and_controls(verbose, inputDict["inputdata"], case_control_dict, case_controlDF)
 
-    tcase_control = time.clock()
+    tcase_control = time.perf_counter()
     if verbose:
         print('Time to label case and control samples is %s'%(tcase_control - tloadedFiles))
 
 
     prepped_for_matchMD= filter_prep_for_matchMD(verbose, case_controlMD, inputDict["match"], inputDict["nullvalues"])
 
-    tprepped = time.clock()
+    tprepped = time.perf_counter()
     if verbose:
         print('Time to filter Metadata information for samples with null values is %s'%(tprepped - tcase_control))
 
@@ -704,8 +845,8 @@ def ControlCaseNullAndMatch(verbose,inputdata,control,case,nullvalues,match,outp
         matchedMD = match_samples(verbose, prepped_for_matchMD, inputDict["match"] )
         matchedMD.to_dataframe().to_csv(output, sep = '\t')
 
-    tmatch = time.clock()
-    tend = time.clock()
+    tmatch = time.perf_counter()
+    tend = time.perf_counter()
     if verbose:
         print('Time to match is %s'%(tmatch- tprepped))
         print('Time to do everything %s'%(tend-tstart))
@@ -740,15 +881,15 @@ def ExcludeControlCaseAndMatch(verbose,inputdata,keep,control,case,match,output)
      
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":keep, "control":control, "case":case, "nullvalues":None, "match":match}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
     afterExclusionMD = keep_samples(verbose, inputDict["inputdata"], inputDict["keep"])
-    tkeep = time.clock()
+    tkeep = time.perf_counter()
     if verbose:
         print('Time to filter out unwanted samples is %s'%(tkeep - tloadedFiles))
     ids = afterExclusionMD.get_ids()
@@ -764,7 +905,7 @@ def ExcludeControlCaseAndMatch(verbose,inputdata,keep,control,case,match,output)
     case_controlMD = determine_cases_and_controls(verbose, afterExclusionMD, case_control_dict, case_controlDF)
 
 
-    tcase_control = time.clock()
+    tcase_control = time.perf_counter()
     if verbose:
         print('Time to label case and control samples is %s'%(tcase_control - tkeep))
 
@@ -772,8 +913,8 @@ def ExcludeControlCaseAndMatch(verbose,inputdata,keep,control,case,match,output)
         matchedMD = match_samples(verbose, case_controlMD, inputDict["match"] )
         matchedMD.to_dataframe().to_csv(output, sep = '\t')
 
-    tmatch = time.clock()
-    tend = time.clock()
+    tmatch = time.perf_counter()
+    tend = time.perf_counter()
     if verbose:
         print('Time to match is %s'%(tmatch- tcase_control))
         print('Time to do everything %s'%(tend-tstart))
@@ -804,16 +945,16 @@ def Everything(verbose,inputdata,keep,control,case,nullvalues,match,output):
 
     '''
     
-    tstart = time.clock()
+    tstart = time.perf_counter()
     inputDict = {"inputdata":inputdata, "keep":keep, "control":control, "case":case, "nullvalues":nullvalues, "match":match}
     #loads and opens input files
     inputDict = get_user_input_query_lines(verbose,inputDict)
     
-    tloadedFiles = time.clock()
+    tloadedFiles = time.perf_counter()
     if verbose:
         print('Time to load input files is %s'%(tloadedFiles - tstart))
     afterExclusionMD = keep_samples(verbose, inputDict["inputdata"], inputDict["keep"])
-    tkeep = time.clock()
+    tkeep = time.perf_counter()
     if verbose:
         print('Time to filter out unwanted samples is %s'%(tkeep - tloadedFiles))
     ids = afterExclusionMD.get_ids()
@@ -828,21 +969,21 @@ def Everything(verbose,inputdata,keep,control,case,nullvalues,match,output):
 
     case_controlMD = determine_cases_and_controls(verbose, afterExclusionMD, case_control_dict, case_controlDF)
 
-    tcase_control = time.clock()
+    tcase_control = time.perf_counter()
     if verbose:
         print('Time to label case and control samples is %s'%(tcase_control - tkeep))
 
     prepped_for_matchMD= filter_prep_for_matchMD(verbose, case_controlMD, inputDict["match"], inputDict["nullvalues"])
 
-    tprepped = time.clock()
+    tprepped = time.perf_counter()
     if verbose:
         print('Time to filter Metadata information for samples with null values is %s'%(tprepped - tcase_control))
 
     if inputDict["match"] != False:
         matchedMD = match_samples(verbose, prepped_for_matchMD, inputDict["match"] )
         matchedMD.to_dataframe().to_csv(output, sep = '\t')
-    tmatch = time.clock()
-    tend = time.clock()
+    tmatch = time.perf_counter()
+    tend = time.perf_counter()
     if verbose:
         print('Time to match is %s'%(tmatch- tprepped))
         print('Time to do everything %s'%(tend-tstart))
@@ -5,6 +5,8 @@ Created on Jun 24, 2018
 '''
 
 import getopt, sys
+import os
+import hashlib
 import pandas as pd
 import numpy as np
 import qiime2
@@ -12,7 +14,7 @@ import time
 
 
 from qiime2 import Metadata
-from collections import defaultdict
+from collections import defaultdict, deque
 
 def get_user_input_query_lines(user_input_file_of_queries):
     '''
@@ -26,14 +28,17 @@ def get_user_input_query_lines(user_input_file_of_queries):
     Returns
     -------
      if user_input_file_of_queries is not ''
-        list of strings that are the lines of the file
+        tuple of strings that are the lines of the file without their newlines
      if user_input_file_of_queries is ''
          returns False boolean
     '''
     if user_input_file_of_queries == '':
         print('null query')
         return False
-    return open('./%s'%(user_input_file_of_queries),'r').readlines()
+    # the with block guarantees the file handle is closed and the lines are
+    # stripped of their newlines once here instead of at every use
+    with open(user_input_file_of_queries, 'r') as file_of_queries:
+        return tuple( line.rstrip('\n') for line in file_of_queries )
 
 
 def keep_samples(original_MD, keep_query_lines):
@@ -201,27 +206,15 @@ def orderDict(dictionary, value_frequency):
     '''
     dictionary_to_return = dictionary.copy()
     for key in dictionary_to_return:
-        unordered_array = dictionary_to_return[key]
+        unordered_array = np.asarray(dictionary_to_return[key])
         if len(unordered_array) == 0:
             continue
-        #ordered_array will store the elements linked to key in their proper order    
-        ordered_array = []
-        count = 0
-        while count < len(unordered_array):
-            value = unordered_array[count]
-            index = 0 #this index is for going through when sorting
-            while index < len(ordered_array):
-                ordered_value = ordered_array[index]
-                if value_frequency[ordered_value] > value_frequency[value]:
-                    ordered_array.insert(index,value)
-                    break
-                index = index + 1
-            if index == len(ordered_array):
-                ordered_array.insert(index,value)
-                
-            count = count + 1
+        #frequency of each element so argsort can rank the elements by how many samples they match to
+        frequencies = np.fromiter( (value_frequency[value] for value in unordered_array), dtype = np.int64, count = len(unordered_array) )
+        #stable argsort keeps elements with equal frequency in their original order
+        order = np.argsort(frequencies, kind = 'stable')
         #overrides the unordered array linked to key with its ordered array
-        dictionary_to_return[key] = ordered_array
+        dictionary_to_return[key] = unordered_array[order].tolist()
 
     return dictionary_to_return
 
@@ -242,22 +235,7 @@ def order_keys(dictionary):
     keys_greatest_to_least: list
         contains keys in order of greatest to least amount of samples they match to
     '''
-    keys_greatest_to_least = []
-    for key in dictionary:
-        if keys_greatest_to_least == []:
-            keys_greatest_to_least.append(key)
-            continue
-        abundance_of_key_values = len(dictionary[key])
-        index = 0
-        for list_key in keys_greatest_to_least:
-            abundance_of_list_key_values = len(dictionary[list_key])
-            if abundance_of_key_values > abundance_of_list_key_values:
-                keys_greatest_to_least.insert(index, key)
-                break
-            index = index + 1
-        if index == len(keys_greatest_to_least):
-            keys_greatest_to_least.append(key)
-
+    keys_greatest_to_least = sorted(dictionary, key=lambda x: len (dictionary[x]), reverse=True)
     return keys_greatest_to_least
 
 
@@ -284,8 +262,10 @@ def stable_marriage(dictionary_pref, pref_counts_cont, pref_counts_case):
         dictionary with keys and their corresponding values representing a match between a case and control sample
     '''
   
-    free_keys = order_keys(dictionary_pref)
- 
+    #keys with no matches can never propose so they are dropped before the loop;
+    #a deque keeps pops and re-queues of bumped keys O(1) at either end
+    free_keys = deque( key for key in order_keys(dictionary_pref) if len(dictionary_pref[key]) != 0 )
+
     one_to_one_match_dictionary = {}
     while free_keys :
         key = free_keys.pop()
@@ -308,18 +288,101 @@ def stable_marriage(dictionary_pref, pref_counts_cont, pref_counts_case):
 
 
 
-def match_samples(prepped_for_match_MD, conditions_for_match_lines):
+def numeric_cache_file(metadata_file, column_names):
+    '''
+    builds the path of the on disk cache file that stores the numeric conversions of
+    the range match columns of metadata_file
+
+    Parameters
+    ----------
+    metadata_file : string
+        path of the metadata file the conversions came from
+
+    column_names : array of strings
+        names of the range match columns kept in the cache
+
+    Returns
+    -------
+    string
+        path of the cache file. The name is keyed on the metadata file path, its
+        modification time and the column names so an edited metadata file or a
+        different condition file never hits a stale cache.
+    '''
+    key = '%s|%s|%s'%(os.path.abspath(metadata_file), os.path.getmtime(metadata_file), ','.join(sorted(column_names)))
+    key_hash = hashlib.md5(key.encode()).hexdigest()
+    return os.path.join(os.path.expanduser('~'), '.cache', 'match_controls', '%s.parquet'%(key_hash))
+
+
+def load_cached_numeric_columns(metadata_file, column_names):
+    '''
+    loads the cached numeric conversions for metadata_file if a cache exists
+
+    Parameters
+    ----------
+    metadata_file : string
+        path of the metadata file the conversions came from. '' disables the cache.
+
+    column_names : array of strings
+        names of the range match columns wanted from the cache
+
+    Returns
+    -------
+    dataframe of the cached numeric columns indexed by sample id, or None when
+    there is no usable cache. A missing or unreadable cache just means the
+    columns get converted again.
+    '''
+    if metadata_file == '' or len(column_names) == 0:
+        return None
+    try:
+        return pd.read_parquet(numeric_cache_file(metadata_file, column_names))
+    except:
+        return None
+
+
+def store_cached_numeric_columns(metadata_file, numericDF):
+    '''
+    writes the numeric conversions of the range match columns to the on disk cache
+    so later runs over the same metadata file skip pd.to_numeric
+
+    Parameters
+    ----------
+    metadata_file : string
+        path of the metadata file the conversions came from. '' disables the cache.
+
+    numericDF : dataframe
+        numeric range match columns indexed by sample id
+    '''
+    if metadata_file == '':
+        return
+    try:
+        cache_file = numeric_cache_file(metadata_file, list(numericDF.columns))
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        numericDF.to_parquet(cache_file)
+    except:
+        # a failed write only loses the speedup of the next run
+        pass
+
+
+def match_samples(prepped_for_match_MD, conditions_for_match_lines, verbose=False, metadata_file=''):
     '''
     matches case samples to controls and puts the case's id in column matched to on the control sample's row
-    
+
     Parameters
     ----------
     prepped_for_match_MD : Metadata object
         Samples that do not have valid entries for columns that determine matching are removed. Everything else is the
         same as merged_MD.
-    
+
     conditions_for_match_lines : dataframe
         contains information on what conditions must be met to constitue a match
+
+    verbose : boolean
+        True makes the timing print statements appear
+
+    metadata_file : string
+        path of the metadata file prepped_for_match_MD was loaded from. When given,
+        the numeric conversions of the range match columns are reused from the on
+        disk cache across runs over the same file. '' disables the cache.
     
     Returns
     -------
@@ -329,103 +392,166 @@ def match_samples(prepped_for_match_MD, conditions_for_match_lines):
     
     '''
     case_dictionary = {}
-    control_dictionary = {}
     control_match_count_dictionary = {}
     case_match_count_dictionary = {}
     
     matchDF = prepped_for_match_MD.to_dataframe()
-    case_for_matchDF = matchDF[matchDF['case_control'].isin(['case'])]
     # creates column to show matches. since it will contain the sample number it was matched too the null value will be 0
     matchDF['matched_to'] = '0'
 
-    
 
-    # loops though case samples and matches them to controls
-    for case_index, case_row in case_for_matchDF.iterrows():
-        #print('case index is %s'%(case_index))
-        
-        # set matchDF to be only the samples of masterDF that are control samples
-        controlDF = matchDF.copy()
-        controlDF = controlDF[controlDF['case_control'].isin(['control'])]
 
-        # loop though input columns to determine matches
-        for conditions in conditions_for_match_lines:
-            
-            column_name = conditions.split('\t')[1].strip()
-            
-            # get the type of data for the given column. This determine how a match is determined
-            if conditions.split('\t')[0] == 'range':
-                num = conditions.split('\t')[2].strip()
-                try:
-                    row_num = float(case_row[column_name])
-                except:
-                    print('%s is not a a valid number'%(case_row[column_name]))
-                    sys.exit(1)
-                    
-                try:
-                    fnum = float(num)
-                except:
-                    print('%s is not a a valid number'%(num))
-                    sys.exit(1)    
-                          
+    # parses the condition lines once into (match type, column name, range number)
+    # tuples so the loops below never re-split the same strings
+    match_plan = []
+    for conditions in conditions_for_match_lines:
+        parts = conditions.split('\t')
+        column_name = parts[1].strip()
+        if parts[0] == 'range':
+            num = parts[2].strip()
+            try:
+                fnum = float(num)
+            except:
+                print('%s is not a a valid number'%(num))
+                sys.exit(1)
+        else:
+            fnum = None
+        match_plan.append((parts[0], column_name, fnum))
+
+    # only the columns named in the conditions are read below, so project them once
+    # instead of dragging every metadata column through the groupbys and case arrays
+    needed_columns = []
+    for match_type, column_name, fnum in match_plan:
+        if column_name not in needed_columns:
+            needed_columns.append(column_name)
+
+    # precomputes what the conditions compare against so the case loop works on
+    # arrays instead of copying and re-filtering a control DataFrame for every case
+    # sample; every array is pre-sliced to the control rows, so the per case
+    # candidates are positions into control_ids rather than into all of matchDF
+    control_mask = (matchDF['case_control'].values == 'control')
+    control_for_matchDF = matchDF.loc[control_mask, needed_columns]
+    control_ids = control_for_matchDF.index.to_numpy()
+    control_row_positions = np.arange(control_ids.size)
+    exact_match_groups = {}
+    exact_match_categories = {}
+    range_match_columns = {}
+    range_column_names = [column_name for match_type, column_name, fnum in match_plan if match_type == 'range']
+    cached_numericDF = load_cached_numeric_columns(metadata_file, range_column_names)
+    freshly_converted = False
+    for match_type, column_name, fnum in match_plan:
+        if match_type == 'range':
+            numbers = None
+            if cached_numericDF is not None and column_name in cached_numericDF:
+                cached_column = cached_numericDF[column_name].reindex(control_ids)
+                # a run with different queries may have cached different control
+                # rows; any missing row falls back to converting the column again
+                if not cached_column.isnull().any():
+                    numbers = cached_column.values
+            if numbers is None:
                 try:
-                    nums_in_column = pd.to_numeric(controlDF[column_name])
+                    numbers = pd.to_numeric(control_for_matchDF[column_name]).values
                 except:
                     print('column %s contains a string that can not be converted to a numerical value'%(column_name))
                     sys.exit(2)
-                          
-                # filters controls based on if the value in the control is not within a given distance form the case
-                controlDF = controlDF[
-                                    ( nums_in_column >= ( row_num - fnum ) ) 
-                                    &
-                                    ( nums_in_column <= ( row_num + fnum ) )
-                                    ] 
-            else:
-                # filters controls if the strings for the control and case don't match
-                controlDF = controlDF[controlDF[column_name].isin([case_row[column_name]])]
-        case_dictionary.update({case_index:controlDF.index.values})
-            
-        # sets the matched to column of masterDF to the case sample ID for the control samples still left in matchDF
-        #sets the control sample 'matched to' value to sample id in master_frame which is the same as the case's index
-        #matchDF['matched_to'] = np.where(matchDF.index.isin(controlDF.index), matchDF['matched_to'] +' ' + case_index, matchDF['matched_to'] )
-        
-        for id_control in controlDF.index:
-            if id_control not in control_match_count_dictionary:
-                control_match_count_dictionary.update({id_control:0})
-            control_match_count_dictionary.update({id_control:(control_match_count_dictionary[id_control]+1)})
-            
-            '''if id_control not in control_dictionary:
-                control_dictionary.update({id_control:[case_index]})
-            else:
-                control_dictionary[id_control].append(case_index)'''
-                          
-        '''if case_index not in case_match_count_dictionary:
-            case_match_count_dictionary.update({case_index:0})'''
-        case_match_count_dictionary.update({case_index:(controlDF.index.values.size)})
-        
+                freshly_converted = True
+            range_match_columns[column_name] = numbers
+        else:
+            # encodes the column as categorical integer codes so the per case bucket
+            # lookups hash small integers instead of strings, then buckets the
+            # control row positions by code once so each case looks its own code up
+            # instead of scanning the whole column
+            categories = pd.Categorical(matchDF[column_name])
+            exact_match_categories[column_name] = categories.categories
+            control_codes = pd.Series(categories.codes[control_mask])
+            exact_match_groups[column_name] = dict(control_codes.groupby(control_codes).indices)
+
+    if freshly_converted:
+        store_cached_numeric_columns(metadata_file, pd.DataFrame({column_name: pd.Series(range_match_columns[column_name], index=control_ids)
+                                                                  for column_name in range_column_names}))
+
+    # iterrows boxes every case row into a Series; pull the needed columns out as
+    # arrays once and build a small dict per case instead
+    # == on the underlying array beats isin with a single element list, which builds
+    # a hash table and probes it per row
+    case_for_matchDF = matchDF.loc[matchDF['case_control'].values == 'case', needed_columns]
+    case_index_array = case_for_matchDF.index.to_numpy()
+    case_column_arrays = {column_name: case_for_matchDF[column_name].to_numpy() for column_name in needed_columns}
+    # exact match columns are compared as integer codes, so encode the case rows once
+    # with the same categories the control buckets were built from; the raw values
+    # stay in case_column_arrays for the range conditions
+    case_exact_codes = {column_name: pd.Categorical(case_for_matchDF[column_name], categories=exact_match_categories[column_name]).codes
+                        for column_name in exact_match_categories}
 
-        
-    '''control_orig = control_dictionary.copy()
-    control_dictionary = orderDict(control_dictionary, case_match_count_dictionary)
-    control_to_case_match = stable_marriage(control_dictionary.copy(), control_match_count_dictionary)
-    control_dictionary = control_orig'''
-    
-    
-    print('start of stable marriage')
-    sm_start = time.clock()
-    case_orig = case_dictionary.copy()
+    # loops though case samples and matches them to controls
+    for case_position in range(len(case_index_array)):
+        case_index = case_index_array[case_position]
+        case_row = {column_name: case_column_arrays[column_name][case_position] for column_name in needed_columns}
+        #print('case index is %s'%(case_index))
+
+        # exact conditions become bucket lookups whose intersection narrows the candidates
+        candidate_positions = control_row_positions
+        for match_type, column_name, fnum in match_plan:
+            if match_type == 'range':
+                continue
+            bucket = exact_match_groups[column_name].get(case_exact_codes[column_name][case_position])
+            if bucket is None:
+                # no control sample shares this value so nothing can match
+                candidate_positions = control_row_positions[:0]
+                break
+            candidate_positions = np.intersect1d(candidate_positions, bucket, assume_unique=True)
+            if candidate_positions.size == 0:
+                break
+
+        # range conditions only look at the rows that survived the exact conditions
+        for match_type, column_name, fnum in match_plan:
+            if match_type != 'range':
+                continue
+            try:
+                row_num = float(case_row[column_name])
+            except:
+                print('%s is not a a valid number'%(case_row[column_name]))
+                sys.exit(1)
+            if candidate_positions.size == 0:
+                continue
+            nums_in_column = range_match_columns[column_name][candidate_positions]
+
+            # filters controls based on if the value in the control is not within a given distance form the case
+            candidate_positions = candidate_positions[
+                                ( nums_in_column >= ( row_num - fnum ) ) & ( nums_in_column <= ( row_num + fnum ) )
+                                ]
+
+        matching_ids = control_ids[candidate_positions]
+        case_dictionary.update({case_index:matching_ids})
+        case_match_count_dictionary.update({case_index:(matching_ids.size)})
+
+    # counts how many case samples every control matched to in one vectorized pass
+    # instead of incrementing a dictionary entry per match inside the case loop
+    if case_dictionary:
+        all_matched_controls = np.concatenate(list(case_dictionary.values()))
+        unique_controls, match_counts = np.unique(all_matched_controls, return_counts=True)
+        control_match_count_dictionary = dict(zip(unique_controls.tolist(), match_counts.tolist()))
+
+
+
+    if verbose:
+        print('start of stable marriage')
+    sm_start = time.perf_counter()
+    #orderDict already copies the dictionary and builds fresh lists, so stable_marriage
+    #is free to pop from them and case_dictionary does not need to be restored after
     case_dictionary = orderDict(case_dictionary, control_match_count_dictionary)
-    
-    case_to_control_match = stable_marriage(case_dictionary.copy(), control_match_count_dictionary, case_match_count_dictionary)
-    case_dictionary = case_orig
-    sm_end = time.clock()
-    print('time to get stable marriage done is %s'%(sm_end - sm_start))
+    case_to_control_match = stable_marriage(case_dictionary, control_match_count_dictionary, case_match_count_dictionary)
+    sm_end = time.perf_counter()
+    if verbose:
+        print('time to get stable marriage done is %s'%(sm_end - sm_start))
     
 
-    for key in case_to_control_match:
-        key_value = case_to_control_match[key]
-        matchDF.loc[ key, 'matched_to'] = key_value
-        matchDF.loc[ key_value, 'matched_to'] = key
+    # two vectorized writes instead of two .loc scalar assignments per matched pair
+    if case_to_control_match:
+        matched_control_ids = np.array(list(case_to_control_match.keys()))
+        matched_case_ids = np.array(list(case_to_control_match.values()))
+        matchDF.loc[ matched_control_ids, 'matched_to'] = matched_case_ids
+        matchDF.loc[ matched_case_ids, 'matched_to'] = matched_control_ids
         
         
         
@@ -443,14 +569,14 @@ plotDF = plotDF.set_index('id')
 
 
 
-tstart = time.clock()
+tstart = time.perf_counter()
 
 # reading in commandline arguments
 all_arguments = sys.argv
 # selecting all arguments after python file name
 argumentList = all_arguments[1:]
-unixOptions = "i:k:c:e:n:m:o:"
-gnuOptions = ["inputData=", "keep=", "control=", "case=", "nullValues=", "match=", "output=", "id=","conditions="]
+unixOptions = "vi:k:c:e:n:m:o:"
+gnuOptions = ["verbose", "inputData=", "keep=", "control=", "case=", "nullValues=", "match=", "output=", "id=","conditions="]
 
 try:  
     arguments, values = getopt.getopt(argumentList, unixOptions, gnuOptions)
@@ -470,11 +596,14 @@ user_input_file_name_match = ''
 
 id_value = ''
 conditions = ''
+#the timing prints only appear when verbose mode is enabled so batch runs stay quiet
+verbose = False
 # evaluate given options
 #print(arguments)
 
-for currentArgument, currentValue in arguments:  
+for currentArgument, currentValue in arguments:
     if currentArgument in ("-v", "--verbose"):
+        verbose = True
         print ("enabling verbose mode")
     elif currentArgument in ("-h", "--help"):
         print ("displaying help")
@@ -527,8 +656,9 @@ the third element is the range number or = (if the match type is exact)
 '''
 match_condition_lines_input = get_user_input_query_lines(user_input_file_name_match)
 
-tloadedFiles = time.clock() 
-print('time to load input files is %s'%(tloadedFiles - tstart))
+tloadedFiles = time.perf_counter() 
+if verbose:
+    print('time to load input files is %s'%(tloadedFiles - tstart))
 
 
 if exclude_query_lines_input != False:
@@ -536,8 +666,9 @@ if exclude_query_lines_input != False:
 else:
     afterExclusionMD = originalMD
 
-tkeep = time.clock() 
-print('time to filter out unwanted samples is %s'%(tkeep - tloadedFiles))
+tkeep = time.perf_counter() 
+if verbose:
+    print('time to filter out unwanted samples is %s'%(tkeep - tloadedFiles))
     
 if case_query_lines_input != False and control_query_lines_input != False:
     ids = afterExclusionMD.get_ids()
@@ -557,31 +688,37 @@ else:
     print('keep exit')
     sys.exit(0)
     
-tcase_control = time.clock() 
-print('time to get case and control samples %s'%(tcase_control - tkeep))
+tcase_control = time.perf_counter() 
+if verbose:
+    print('time to get case and control samples %s'%(tcase_control - tkeep))
     
 if null_values_lines_input == False or match_condition_lines_input == False:
     prepped_for_matchMD = case_controlMD
-    print('no nulls')
+    if verbose:
+        print('no nulls')
 else:    
     prepped_for_matchMD= filter_prep_for_matchMD(case_controlMD, match_condition_lines_input, null_values_lines_input)
 
     
-tprepped = time.clock() 
-print('time to prep Metadata information for match is %s'%(tprepped - tcase_control))
+tprepped = time.perf_counter() 
+if verbose:
+    print('time to prep Metadata information for match is %s'%(tprepped - tcase_control))
 
 if match_condition_lines_input != False:
-    matchedMD = match_samples( prepped_for_matchMD, match_condition_lines_input )
+    matchedMD = match_samples( prepped_for_matchMD, match_condition_lines_input, verbose, file_of_metadata )
     matchedMD.to_dataframe().to_csv(outputFileName, sep = '\t')
 
-tmatch = time.clock()  
-tend = time.clock()
-print('time to match is %s'%(tmatch- tprepped))
-print('time to do everything %s'%(tend-tstart))
+tmatch = time.perf_counter()  
+tend = time.perf_counter()
+if verbose:
+    print('time to match is %s'%(tmatch- tprepped))
+    print('time to do everything %s'%(tend-tstart))
 
 
 
-plotDF = plotDF.append(pd.Series( {'dataset':file_of_metadata, 'conditions':conditions, 'case_control':(tcase_control- tkeep), 'match':(tmatch- tprepped), 'total':(tend-tstart), 'null_filter':(tprepped - tcase_control), 'keep':(tkeep - tloadedFiles), 'load':(tloadedFiles - tstart)}).rename(id_value) )
+#.loc inserts the single timing row in place; DataFrame.append copied the whole
+#frame every run and is removed in pandas 2.0
+plotDF.loc[id_value] = pd.Series( {'dataset':file_of_metadata, 'conditions':conditions, 'case_control':(tcase_control- tkeep), 'match':(tmatch- tprepped), 'total':(tend-tstart), 'null_filter':(tprepped - tcase_control), 'keep':(tkeep - tloadedFiles), 'load':(tloadedFiles - tstart)} )
 
 plotDF.to_csv('data_plot.csv', sep = '\t')
 